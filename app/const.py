@@ -1,2 +1,15 @@
+import os
+
 DEFAULT_PAGE_SIZE = 100
 API_V1_PREFIX = "/api/v1"
+# only pages of up to this many rows are cached, so the query cache holds at
+# most QUERY_CACHE_SIZE results of that size
+QUERY_CACHE_SIZE = 1024
+QUERY_CACHE_MAX_PAGE_SIZE = DEFAULT_PAGE_SIZE
+EXPORT_BATCH_SIZE = 1024
+
+# duckdb queries block, so endpoints run in the threadpool (anyio default is 40)
+THREADPOOL_SIZE = 200
+
+# threads duckdb may use per query, every gunicorn worker holds its own database
+DUCKDB_THREADS = int(os.environ.get("DUCKDB_THREADS") or os.cpu_count() or 1)
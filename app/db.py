@@ -1,44 +1,60 @@
 import duckdb
 import logging
+import threading
+from typing import Iterator
+
+from app.const import DUCKDB_THREADS
 
 logger = logging.getLogger()
 
 
+SEED_TABLES = ["customers", "orders", "items", "products", "stores", "supplies"]
+# art indexes for columns the api looks up many values of, name -> (table, column)
+SEED_INDEXES = {"idx_items_order_id": ("items", "order_id")}
+
 POPULATED_DB: duckdb.DuckDBPyConnection | None = None
+_POPULATE_LOCK = threading.Lock()
+
+# the seed tables are never written to, so row counts are computed once on load
+ROW_COUNTS: dict[str, int] = {}
 
 
-def get_db() -> duckdb.DuckDBPyConnection:
+def get_populated_db() -> duckdb.DuckDBPyConnection:
     """Create in memory duckdb database from seed csv files"""
     global POPULATED_DB
 
     if POPULATED_DB is None:
-        db = duckdb.connect(database=":memory:")
-        db.sql(
-            "CREATE TABLE customers AS SELECT * FROM read_csv('seed/raw_customers.csv');"
-        )
-        db.sql("CREATE TABLE orders AS SELECT * FROM read_csv('seed/raw_orders.csv');")
-        db.sql("CREATE TABLE items AS SELECT * FROM read_csv('seed/raw_items.csv');")
-        db.sql(
-            "CREATE TABLE products AS SELECT * FROM read_csv('seed/raw_products.csv');"
-        )
-        db.sql("CREATE TABLE stores AS SELECT * FROM read_csv('seed/raw_stores.csv');")
-        db.sql(
-            "CREATE TABLE supplies AS SELECT * FROM read_csv('seed/raw_supplies.csv');"
-        )
-        POPULATED_DB = db
-
-        logger.warning("Loaded seed data")
-        logger.warning(
-            f"Customers: {db.sql('SELECT COUNT(*) FROM customers').fetchone()[0]}"
-        )
-        logger.warning(f"Orders: {db.sql('SELECT COUNT(*) FROM orders').fetchone()[0]}")
-        logger.warning(f"Items: {db.sql('SELECT COUNT(*) FROM items').fetchone()[0]}")
-        logger.warning(
-            f"Products: {db.sql('SELECT COUNT(*) FROM products').fetchone()[0]}"
-        )
-        logger.warning(f"Stores: {db.sql('SELECT COUNT(*) FROM stores').fetchone()[0]}")
-        logger.warning(
-            f"Supplies: {db.sql('SELECT COUNT(*) FROM supplies').fetchone()[0]}"
-        )
+        with _POPULATE_LOCK:
+            if POPULATED_DB is None:
+                db = duckdb.connect(
+                    database=":memory:", config={"threads": DUCKDB_THREADS}
+                )
+                for table in SEED_TABLES:
+                    db.sql(
+                        f"CREATE TABLE {table} AS SELECT * FROM read_csv('seed/raw_{table}.csv');"
+                    )
+                    ROW_COUNTS[table] = db.sql(
+                        f"SELECT COUNT(*) FROM {table}"
+                    ).fetchone()[0]
+                for index, (table, column) in SEED_INDEXES.items():
+                    db.sql(f"CREATE INDEX IF NOT EXISTS {index} ON {table}({column});")
+                POPULATED_DB = db
+
+                logger.warning("Loaded seed data")
+                for table, count in ROW_COUNTS.items():
+                    logger.warning(f"{table.capitalize()}: {count}")
 
     return POPULATED_DB
+
+
+def get_db() -> Iterator[duckdb.DuckDBPyConnection]:
+    """
+    Yield a cursor on the shared in memory database for a single request.
+    Connections are not thread safe, so every request gets its own cursor
+    instead of sharing the populated connection across worker threads
+    """
+    cursor = get_populated_db().cursor()
+    try:
+        yield cursor
+    finally:
+        cursor.close()
@@ -1,8 +1,19 @@
+from contextlib import asynccontextmanager
+
+import anyio.to_thread
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from app import routers
-from app.const import API_V1_PREFIX
+from app.const import API_V1_PREFIX, THREADPOOL_SIZE
 from app.models import Message
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    yield
+
+
 app = FastAPI(
     title="dltHub Jaffle Shop API",
     version="1.0.0",
@@ -16,6 +27,8 @@ app = FastAPI(
         "url": "https://dlthub.com",
         "email": "support@dlt.hub",
     },
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 # api v1
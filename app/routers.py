@@ -2,14 +2,26 @@
 All jaffle shop routers for api v1
 """
 
-from typing import List
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from enum import Enum
+from functools import lru_cache
+from typing import Annotated, List
 
 import duckdb
-from urllib.parse import urlencode
-from fastapi import APIRouter, Depends, Response, Request
-
-from app.db import get_db
-from app.const import DEFAULT_PAGE_SIZE, API_V1_PREFIX
+import orjson
+import pyarrow as pa
+from fastapi import APIRouter, Depends, Query, Response, Request
+from fastapi.responses import ORJSONResponse, StreamingResponse
+
+from app.db import ROW_COUNTS, get_db, get_populated_db
+from app.const import (
+    DEFAULT_PAGE_SIZE,
+    EXPORT_BATCH_SIZE,
+    QUERY_CACHE_MAX_PAGE_SIZE,
+    QUERY_CACHE_SIZE,
+)
 from app.models import Customer, Order, Item, Product, Store, Supply
 
 general_router = APIRouter(tags=["general"])
@@ -20,34 +32,150 @@ product_router = APIRouter(tags=["products"])
 supplies_router = APIRouter(tags=["supplies"])
 store_router = APIRouter(tags=["stores"])
 
+# response model and lookup key of each table
+_TABLES = {
+    "customers": (Customer, "id"),
+    "orders": (Order, "id"),
+    "items": (Item, "id"),
+    "products": (Product, "sku"),
+    "stores": (Store, "id"),
+    "supplies": (Supply, "id"),
+}
+# fields filled in from other tables, not selected from the table itself
+_NESTED_FIELDS = {"items"}
+
+
+def _select_columns(model) -> str:
+    """
+    Select only the columns the response model exposes
+    Decimals are selected as text, so rows that skip pydantic validation
+    serialize the same way the model would serialize them
+    """
+    columns = []
+    for name, field in model.model_fields.items():
+        if name in _NESTED_FIELDS:
+            continue
+        if field.annotation is Decimal:
+            columns.append(f'"{name}"::VARCHAR AS "{name}"')
+        else:
+            columns.append(f'"{name}"')
+    return ", ".join(columns)
+
+
+_COLUMNS = {
+    table_name: _select_columns(model) for table_name, (model, _) in _TABLES.items()
+}
+# names of the selected columns in select order, used to build single row dicts
+_COLUMN_NAMES = {
+    table_name: tuple(name for name in model.model_fields if name not in _NESTED_FIELDS)
+    for table_name, (model, _) in _TABLES.items()
+}
+
+# rowid starts at 0, so the first page starts after rowid -1
+_FIRST_ROWID = -1
+_PAGED_QUERY = (
+    "SELECT {columns}, rowid FROM {table_name} WHERE rowid > ?{where_clause} "
+    "ORDER BY rowid LIMIT ? OFFSET ?"
+)
 
-def _get_list_response(db: duckdb.DuckDBPyConnection, query: str):
+# date filters of the orders collection, keyed by (has start_date, has end_date)
+# ordered_at is compared uncast against a half-open timestamp range, so duckdb
+# can skip row groups using the min/max statistics of the column
+_ORDERS_DATE_FILTERS = {
+    (False, False): "",
+    (True, False): " AND ordered_at >= ?",
+    (False, True): " AND ordered_at < ?",
+    (True, True): " AND ordered_at >= ? AND ordered_at < ?",
+}
+# the where clauses each collection may be filtered with
+_WHERE_CLAUSES = {table_name: [""] for table_name in _TABLES}
+_WHERE_CLAUSES["orders"] = list(_ORDERS_DATE_FILTERS.values())
+
+# only these (table, where clause) combinations can be paged
+_PAGED_QUERIES = {
+    (table_name, where_clause): _PAGED_QUERY.format(
+        columns=_COLUMNS[table_name],
+        table_name=table_name,
+        where_clause=where_clause,
+    )
+    for table_name, where_clauses in _WHERE_CLAUSES.items()
+    for where_clause in where_clauses
+}
+# stop scanning at the first match, the key columns have no unique index
+_SINGLE_QUERIES = {
+    table_name: (
+        f"SELECT {_COLUMNS[table_name]} FROM {table_name} WHERE {key} = ? LIMIT 1"
+    )
+    for table_name, (_, key) in _TABLES.items()
+}
+_EXPORT_QUERIES = {
+    table_name: f"SELECT {_COLUMNS[table_name]} FROM {table_name} ORDER BY rowid"
+    for table_name in _TABLES
+}
+# path parameter of the export endpoint, one member per exportable table
+ExportTable = Enum("ExportTable", {name: name for name in _EXPORT_QUERIES}, type=str)
+
+
+def _run_query(query: str, params: tuple) -> pa.Table:
+    """
+    Run a query on its own cursor and return the result as an arrow table
+    """
+    with get_populated_db().cursor() as cursor:
+        return cursor.execute(query, params).fetch_arrow_table()
+
+
+# the seed tables never change, so results can be reused until evicted. The
+# cache is bounded by entries, not bytes, so callers only use it for pages of
+# up to QUERY_CACHE_MAX_PAGE_SIZE rows
+_run_cached_query = lru_cache(maxsize=QUERY_CACHE_SIZE)(_run_query)
+
+
+def _get_list_response(query: str, params=(), cached: bool = True):
     """
     Get a list response from a collection endpoint
+    Arrow builds fresh row dicts on every call, so callers may modify them
+    without touching the cache
     """
-    cursor = db.sql(query)
-    column_names = [desc[0] for desc in cursor.description]
-    return [dict(zip(column_names, row)) for row in cursor.fetchall()]
+    run_query = _run_cached_query if cached else _run_query
+    return run_query(query, tuple(params)).to_pylist()
 
 
 def _get_paged_response(
-    db: duckdb.DuckDBPyConnection,
     request: Request,
     table_name: str,
     page: int = 1,
+    after: int = None,
     response: Response = None,
     where_clause: str = "",
-    sort_by: str = "",
+    params=(),
     page_size: int = DEFAULT_PAGE_SIZE,
 ):
     """
     Get a paged response from a collection endpoint
-    Will insert next header if applicable
+    Rows are ordered by rowid, which doubles as the keyset cursor: if `after`
+    is given the page starts after that rowid, otherwise `page` is used.
+    `where_clause` holds extra `AND ...` conditions bound to `params`, it
+    must be one of the clauses registered for the table in _WHERE_CLAUSES.
+    Will insert next header (pointing to the `after` cursor) if applicable
     """
 
-    offset = (page - 1) * page_size
-    last_item = offset + page_size
-    count = db.query(f"SELECT COUNT(*) FROM {table_name} {where_clause}").fetchone()[0]
+    if after is not None:
+        offset = 0
+    else:
+        after = _FIRST_ROWID
+        offset = (page - 1) * page_size
+
+    query = _PAGED_QUERIES[(table_name, where_clause)]
+
+    # fetch one extra row to find out whether there is a next page
+    run_query = (
+        _run_cached_query if page_size <= QUERY_CACHE_MAX_PAGE_SIZE else _run_query
+    )
+    table = run_query(query, (after, *params, page_size + 1, offset))
+    has_next = table.num_rows > page_size
+    table = table.slice(0, page_size)
+    last_rowid = table["rowid"][-1].as_py() if table.num_rows else None
+    rows = table.drop_columns(["rowid"]).to_pylist()
 
     # get base url from request
     # forwarded_host = request.headers.get(
@@ -55,26 +183,39 @@ def _get_paged_response(
     # )
     # scheme = request.headers.get("X-Forwarded-Proto", "http")
 
-    url = API_V1_PREFIX + f"/{table_name}"
-    query_params = dict(request.query_params)
-    if last_item < count and response:
-        query_params["page"] = page + 1
-        next_link = f'<{url}?{urlencode(query_params)}>; rel="next"'
-        response.headers["Link"] = next_link
+    if has_next and last_rowid is not None and response:
+        next_url = request.url.remove_query_params("page").include_query_params(
+            after=last_rowid
+        )
+        response.headers["Link"] = f'<{next_url.path}?{next_url.query}>; rel="next"'
+
+    return rows
 
-    return _get_list_response(
-        db,
-        f"SELECT * FROM {table_name} {where_clause} {sort_by} LIMIT {page_size} OFFSET {offset}",
-    )
+
+def _get_ndjson_response(query: str, params=()):
+    """
+    Stream a query result as newline delimited json
+    Only one arrow record batch is held in memory at a time. The stream runs
+    after the request dependencies are closed, so it uses its own cursor
+    """
+
+    def lines():
+        with get_populated_db().cursor() as cursor:
+            reader = cursor.execute(query, params).fetch_record_batch(EXPORT_BATCH_SIZE)
+            for batch in reader:
+                yield b"".join(orjson.dumps(row) + b"\n" for row in batch.to_pylist())
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
 
-def _get_single_response(db: duckdb.DuckDBPyConnection, query: str):
+def _get_single_response(db: duckdb.DuckDBPyConnection, table_name: str, params=()):
     """
     Get a single response from a collection endpoint
+    Column names are known from the response model, so the cursor
+    description is never read
     """
-    cursor = db.sql(query)
-    column_names = [desc[0] for desc in cursor.description]
-    return dict(zip(column_names, cursor.fetchone()))
+    row = db.execute(_SINGLE_QUERIES[table_name], params).fetchone()
+    return dict(zip(_COLUMN_NAMES[table_name], row))
 
 
 #
@@ -83,53 +224,59 @@ def _get_single_response(db: duckdb.DuckDBPyConnection, query: str):
 
 
 @general_router.get("/row-counts")
-async def row_counts(db: duckdb.DuckDBPyConnection = Depends(get_db)):
-    selected_tables = ["customers", "orders", "items", "products", "stores", "supplies"]
-    queries = []
-    for table in selected_tables:
-        queries.append(
-            f"SELECT '{table}' as table_name, COUNT(*) as row_count FROM {table}"
-        )
+def row_counts():
+    # counts are cached when the seed data is loaded (see get_populated_db)
+    get_populated_db()
+    return [
+        {"table_name": table, "row_count": count} for table, count in ROW_COUNTS.items()
+    ]
 
-    query = " UNION ALL ".join(queries)
-    return _get_list_response(db, query)
+
+@general_router.get(
+    "/export/{table_name}",
+    response_class=StreamingResponse,
+    description=(
+        "Streams the full table as newline delimited json, one row per line.\n\n"
+        "Orders are exported without their nested items.\n\n"
+    ),
+)
+def export_table(table_name: ExportTable):
+    return _get_ndjson_response(_EXPORT_QUERIES[table_name.value])
 
 
 @customers_router.get(
     "/customers",
-    response_model=List[Customer],
+    responses={200: {"model": List[Customer]}},
     description=(
         "Returns a paginated list of customers.\n\n"
         "Pagination is controlled via the `page` query parameter (see `page`).\n\n"
+        "Alternatively pass the opaque `after` cursor from the `Link` header to resume after the last returned row.\n\n"
         "Each page returns a fixed number of results (see `page_size`).\n\n"
         "If more results are available, the response will include a `Link` header with `rel=\"next\"` "
         "that points to the next page.\n\n"
     )
 )
-async def get_customers(
-    page: int = 1,
-    page_size: int = DEFAULT_PAGE_SIZE,
+def get_customers(
+    page: Annotated[int, Query(ge=1)] = 1,
+    page_size: Annotated[int, Query(ge=1)] = DEFAULT_PAGE_SIZE,
+    after: int = None,
     response: Response = None,
     request: Request = None,
-    db: duckdb.DuckDBPyConnection = Depends(get_db),
 ):
-    return _get_paged_response(
-        db=db,
+    rows = _get_paged_response(
         request=request,
         table_name="customers",
         page=page,
+        after=after,
         response=response,
         page_size=page_size,
     )
+    return ORJSONResponse(rows, headers=response.headers)
 
 
 @customers_router.get("/customers/{customer_id}", response_model=Customer)
-async def get_customer(
-    customer_id: str, db: duckdb.DuckDBPyConnection = Depends(get_db)
-):
-    return _get_single_response(
-        db, f"SELECT * FROM customers WHERE id = '{customer_id}'"
-    )
+def get_customer(customer_id: str, db: duckdb.DuckDBPyConnection = Depends(get_db)):
+    return _get_single_response(db, "customers", [customer_id])
 
 
 #
@@ -137,61 +284,72 @@ async def get_customer(
 #
 
 
-def _enrich_orders(db: duckdb.DuckDBPyConnection, orders: list[dict]):
+def _enrich_orders(orders: list[dict]):
     """
-    Enrich orders with list of items
+    Enrich orders with list of items, fetched for all orders in a single query
     """
+    if not orders:
+        return orders
+
+    placeholders = ", ".join("?" for _ in orders)
+    items = _get_list_response(
+        f"SELECT {_COLUMNS['items']} FROM items WHERE order_id IN ({placeholders})",
+        [order["id"] for order in orders],
+        cached=len(orders) <= QUERY_CACHE_MAX_PAGE_SIZE,
+    )
+    items_by_order = defaultdict(list)
+    for item in items:
+        items_by_order[item["order_id"]].append(item)
+
     for order in orders:
-        order["items"] = _get_list_response(
-            db, f"SELECT * FROM items WHERE order_id = '{order['id']}'"
-        )
+        order["items"] = items_by_order[order["id"]]
     return orders
 
 
 @orders_router.get(
     "/orders",
-    response_model=List[Order],
+    responses={200: {"model": List[Order]}},
     description=(
         "Returns a paginated list of orders.\n\n"
         "Pagination is controlled via the `page` query parameter (see `page`).\n\n"
+        "Alternatively pass the opaque `after` cursor from the `Link` header to resume after the last returned row.\n\n"
         "Each page returns a fixed number of results (see `page_size`).\n\n"
         "If more results are available, the response will include a `Link` header with `rel=\"next\"` "
         "that points to the next page.\n\n"
     )
 )
-async def get_orders(
-    page: int = 1,
-    page_size: int = DEFAULT_PAGE_SIZE,
-    start_date: str = None,
-    end_date: str = None,
+def get_orders(
+    page: Annotated[int, Query(ge=1)] = 1,
+    page_size: Annotated[int, Query(ge=1)] = DEFAULT_PAGE_SIZE,
+    after: int = None,
+    start_date: date = None,
+    end_date: date = None,
     response: Response = None,
     request: Request = None,
-    db: duckdb.DuckDBPyConnection = Depends(get_db),
 ):
-    where_clause = ""
-    if start_date:
-        where_clause += f" AND ordered_at::DATE >= '{start_date}'"
-    if end_date:
-        where_clause += f" AND ordered_at::DATE <= '{end_date}'"
-    if where_clause:
-        where_clause = f"WHERE {where_clause[5:]}"
+    where_clause = _ORDERS_DATE_FILTERS[(start_date is not None, end_date is not None)]
+    params = []
+    if start_date is not None:
+        params.append(datetime.combine(start_date, time.min))
+    if end_date is not None:
+        # end_date is inclusive, so the range ends at the start of the next day
+        params.append(datetime.combine(end_date + timedelta(days=1), time.min))
     orders = _get_paged_response(
-        db=db,
         request=request,
         table_name="orders",
         page=page,
+        after=after,
         page_size=page_size,
         response=response,
         where_clause=where_clause,
+        params=params,
     )
-    return _enrich_orders(db, orders)
+    return ORJSONResponse(_enrich_orders(orders), headers=response.headers)
 
 
 @orders_router.get("/orders/{order_id}", response_model=Order)
-async def get_order(order_id: str, db: duckdb.DuckDBPyConnection = Depends(get_db)):
-    return _enrich_orders(
-        db, [_get_single_response(db, f"SELECT * FROM orders WHERE id = '{order_id}'")]
-    )[0]
+def get_order(order_id: str, db: duckdb.DuckDBPyConnection = Depends(get_db)):
+    return _enrich_orders([_get_single_response(db, "orders", [order_id])])[0]
 
 
 #
@@ -199,35 +357,37 @@ async def get_order(order_id: str, db: duckdb.DuckDBPyConnection = Depends(get_d
 #
 @item_router.get(
     "/items",
-    response_model=List[Item],
+    responses={200: {"model": List[Item]}},
     description=(
         "Returns a paginated list of items.\n\n"
         "Pagination is controlled via the `page` query parameter (see `page`).\n\n"
+        "Alternatively pass the opaque `after` cursor from the `Link` header to resume after the last returned row.\n\n"
         "Each page returns a fixed number of results (see `page_size`).\n\n"
         "If more results are available, the response will include a `Link` header with `rel=\"next\"` "
         "that points to the next page.\n\n"
     )
 )
-async def get_items(
-    page: int = 1,
-    page_size: int = DEFAULT_PAGE_SIZE,
+def get_items(
+    page: Annotated[int, Query(ge=1)] = 1,
+    page_size: Annotated[int, Query(ge=1)] = DEFAULT_PAGE_SIZE,
+    after: int = None,
     response: Response = None,
     request: Request = None,
-    db: duckdb.DuckDBPyConnection = Depends(get_db),
 ):
-    return _get_paged_response(
-        db=db,
+    rows = _get_paged_response(
         request=request,
         table_name="items",
         page=page,
+        after=after,
         response=response,
         page_size=page_size,
     )
+    return ORJSONResponse(rows, headers=response.headers)
 
 
 @item_router.get("/items/{item_id}", response_model=Item)
-async def get_item(item_id: str, db: duckdb.DuckDBPyConnection = Depends(get_db)):
-    return _get_single_response(db, f"SELECT * FROM items WHERE id = '{item_id}'")
+def get_item(item_id: str, db: duckdb.DuckDBPyConnection = Depends(get_db)):
+    return _get_single_response(db, "items", [item_id])
 
 
 #
@@ -235,35 +395,37 @@ async def get_item(item_id: str, db: duckdb.DuckDBPyConnection = Depends(get_db)
 #
 @product_router.get(
     "/products",
-    response_model=List[Product],
+    responses={200: {"model": List[Product]}},
     description=(
         "Returns a paginated list of products.\n\n"
         "Pagination is controlled via the `page` query parameter (see `page`).\n\n"
+        "Alternatively pass the opaque `after` cursor from the `Link` header to resume after the last returned row.\n\n"
         "Each page returns a fixed number of results (see `page_size`).\n\n"
         "If more results are available, the response will include a `Link` header with `rel=\"next\"` "
         "that points to the next page.\n\n"
     )
 )
-async def get_products(
-    page: int = 1,
-    page_size: int = DEFAULT_PAGE_SIZE,
+def get_products(
+    page: Annotated[int, Query(ge=1)] = 1,
+    page_size: Annotated[int, Query(ge=1)] = DEFAULT_PAGE_SIZE,
+    after: int = None,
     response: Response = None,
     request: Request = None,
-    db: duckdb.DuckDBPyConnection = Depends(get_db),
 ):
-    return _get_paged_response(
-        db=db,
+    rows = _get_paged_response(
         request=request,
         table_name="products",
         page=page,
+        after=after,
         response=response,
         page_size=page_size,
     )
+    return ORJSONResponse(rows, headers=response.headers)
 
 
 @product_router.get("/products/{sku}", response_model=Product)
-async def get_product(sku: str, db: duckdb.DuckDBPyConnection = Depends(get_db)):
-    return _get_single_response(db, f"SELECT * FROM products WHERE sku = '{sku}'")
+def get_product(sku: str, db: duckdb.DuckDBPyConnection = Depends(get_db)):
+    return _get_single_response(db, "products", [sku])
 
 
 #
@@ -271,35 +433,37 @@ async def get_product(sku: str, db: duckdb.DuckDBPyConnection = Depends(get_db))
 #
 @store_router.get(
     "/stores",
-    response_model=List[Store],
+    responses={200: {"model": List[Store]}},
     description=(
         "Returns a paginated list of stores.\n\n"
         "Pagination is controlled via the `page` query parameter (see `page`).\n\n"
+        "Alternatively pass the opaque `after` cursor from the `Link` header to resume after the last returned row.\n\n"
         "Each page returns a fixed number of results (see `page_size`).\n\n"
         "If more results are available, the response will include a `Link` header with `rel=\"next\"` "
         "that points to the next page.\n\n"
     )
 )
-async def get_stores(
-    page: int = 1,
-    page_size: int = DEFAULT_PAGE_SIZE,
+def get_stores(
+    page: Annotated[int, Query(ge=1)] = 1,
+    page_size: Annotated[int, Query(ge=1)] = DEFAULT_PAGE_SIZE,
+    after: int = None,
     response: Response = None,
     request: Request = None,
-    db: duckdb.DuckDBPyConnection = Depends(get_db),
 ):
-    return _get_paged_response(
-        db=db,
+    rows = _get_paged_response(
         request=request,
         table_name="stores",
         page=page,
+        after=after,
         response=response,
         page_size=page_size,
     )
+    return ORJSONResponse(rows, headers=response.headers)
 
 
 @store_router.get("/stores/{store_id}", response_model=Store)
-async def get_store(store_id: str, db: duckdb.DuckDBPyConnection = Depends(get_db)):
-    return _get_single_response(db, f"SELECT * FROM stores WHERE id = '{store_id}'")
+def get_store(store_id: str, db: duckdb.DuckDBPyConnection = Depends(get_db)):
+    return _get_single_response(db, "stores", [store_id])
 
 
 #
@@ -307,32 +471,34 @@ async def get_store(store_id: str, db: duckdb.DuckDBPyConnection = Depends(get_d
 #
 @supplies_router.get(
     "/supplies",
-    response_model=List[Supply],
+    responses={200: {"model": List[Supply]}},
     description=(
         "Returns a paginated list of supplies.\n\n"
         "Pagination is controlled via the `page` query parameter (see `page`).\n\n"
+        "Alternatively pass the opaque `after` cursor from the `Link` header to resume after the last returned row.\n\n"
         "Each page returns a fixed number of results (see `page_size`).\n\n"
         "If more results are available, the response will include a `Link` header with `rel=\"next\"` "
         "that points to the next page.\n\n"
     )
 )
-async def get_supplies(
-    page: int = 1,
-    page_size: int = DEFAULT_PAGE_SIZE,
+def get_supplies(
+    page: Annotated[int, Query(ge=1)] = 1,
+    page_size: Annotated[int, Query(ge=1)] = DEFAULT_PAGE_SIZE,
+    after: int = None,
     response: Response = None,
     request: Request = None,
-    db: duckdb.DuckDBPyConnection = Depends(get_db),
 ):
-    return _get_paged_response(
-        db=db,
+    rows = _get_paged_response(
         request=request,
         table_name="supplies",
         page=page,
+        after=after,
         response=response,
         page_size=page_size,
     )
+    return ORJSONResponse(rows, headers=response.headers)
 
 
 @supplies_router.get("/supplies/{supply_id}", response_model=Supply)
-async def get_supply(supply_id: str, db: duckdb.DuckDBPyConnection = Depends(get_db)):
-    return _get_single_response(db, f"SELECT * FROM supplies WHERE id = '{supply_id}'")
+def get_supply(supply_id: str, db: duckdb.DuckDBPyConnection = Depends(get_db)):
+    return _get_single_response(db, "supplies", [supply_id])